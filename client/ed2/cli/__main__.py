@@ -15,12 +15,35 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import sys
+import os
 import argparse
 import logging
 
 from ..zmq_client import ZmqClient
 from ..zmq_server import ZmqServer
 
+# Number of lines to pipeline at once when stdin is not interactive.
+batch_size = 64
+
+prompt = b'>  '
+rep_prefix = b'<  '
+rep_suffix = b'\n' + prompt
+
+def writeRep(stdout, rep):
+    # Write the parts separately into the buffer, instead of concatenating them first.
+    stdout.write(rep_prefix)
+    stdout.write(rep)
+    stdout.write(rep_suffix)
+
+def reqBatch(client, lines, stdout):
+    reps = iter(client.reqMany([line for line in lines if len(line) > 0]))
+    for line in lines:
+        if len(line) > 0:
+            writeRep(stdout, next(reps))
+        else:
+            stdout.write(prompt)
+    stdout.flush()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='ZMQ command line client')
     parser.add_argument('-s', dest='server', type=str, default='localhost', help='ZMQ server to connect to')
@@ -34,19 +57,37 @@ if __name__ == '__main__':
 
     client = ZmqClient(args.server, args.port, multi=True)
 
+    # Write the raw bytes via one large buffer, and only flush when needed.
+    sys.stdout.flush()
+    stdout = os.fdopen(sys.stdout.fileno(), 'wb', buffering=1 << 20, closefd=False)
+
+    # Read raw bytes; there is no need to decode the input, as it is sent as-is.
+    stdin = sys.stdin.buffer
+
     try:
-        prefix = '>  '
-        sys.stdout.write(prefix)
-        sys.stdout.flush()
-        for line in sys.stdin:
-            line = line.strip()
-            if len(line) > 0:
-                print('<  ' + client.req(line.encode()).decode())
-            sys.stdout.write(prefix)
-            sys.stdout.flush()
+        stdout.write(prompt)
+        stdout.flush()
+        if sys.stdin.isatty():
+            for line in iter(stdin.readline, b''):
+                line = line.strip()
+                if len(line) > 0:
+                    writeRep(stdout, client.req(line))
+                else:
+                    stdout.write(prompt)
+                stdout.flush()
+        else:
+            # Scripted input; pipeline the requests.
+            batch = []
+            for line in iter(stdin.readline, b''):
+                batch.append(line.strip())
+                if len(batch) >= batch_size:
+                    reqBatch(client, batch, stdout)
+                    batch = []
+            reqBatch(client, batch, stdout)
 
     except KeyboardInterrupt:
         pass
 
+    stdout.flush()
     client.close()
 
@@ -17,60 +17,51 @@
 import csv
 import time
 import threading
-import queue
+import collections
+import bisect
+import itertools
 import logging
 import os
-
-from PySide2.QtCore import QObject, Signal, Slot, Property
+import io
+
+from PySide2.QtCore import QObject, Signal, Slot, Property, QTimer, QThread
+
+_localtimeCache = (None, None)
+
+def _localtime():
+    # File names only have a resolution of a second; reuse the struct_time
+    # when called multiple times within the same second.
+    global _localtimeCache
+    now = int(time.time())
+    if _localtimeCache[0] != now:
+        _localtimeCache = (now, time.localtime(now))
+    return _localtimeCache[1]
+
+def _toList(x):
+    if isinstance(x, list):
+        return x, True
+    elif x is None:
+        return [], False
+    else:
+        return [x], False
 
 def generateFilename(filename=None, base=None, addTimestamp=False, ext='.csv', now=None):
     if filename == None and base == None:
         raise ValueError('Specify filename and/or base')
 
-    returnList = False
-
-    if not isinstance(filename, list):
-        if filename is None:
-            filename = []
-        else:
-            filename = [filename]
-    else:
-        returnList = True
-
-    if not isinstance(base, list):
-        if base is None:
-            base = []
-        else:
-            base = [base]
-    else:
-        returnList = True
-
-    if not isinstance(ext, list):
-        if ext is None:
-            ext = []
-        else:
-            ext = [ext]
-    else:
-        returnList = True
-
-    names = []
+    filename, filenameList = _toList(filename)
+    base, baseList = _toList(base)
+    ext, extList = _toList(ext)
+    returnList = filenameList or baseList or extList
 
-    for f in filename:
-        names.append(os.path.splitext(f))
-
-    for e in ext:
-        for b in base:
-            names.append((b, e))
+    names = [os.path.splitext(f) for f in filename]
+    names += [(b, e) for e in ext for b in base]
 
     if now == None:
-        now = time.localtime()
-
-    if addTimestamp:
-        for i in range(0, len(names)):
-            names[i] = (names[i][0] + '_%Y%m%d-%H%M%S%z', names[i][1])
+        now = _localtime()
 
-    for i in range(0, len(names)):
-        names[i] = time.strftime(names[i][0] + names[i][1], now)
+    timestamp = '_%Y%m%d-%H%M%S%z' if addTimestamp else ''
+    names = [time.strftime(n + timestamp + e, now) for n, e in names]
 
     if returnList:
         return names
@@ -82,98 +73,220 @@ def generateFilename(filename=None, base=None, addTimestamp=False, ext='.csv', n
         return names
 
 class CsvExport(QObject):
-    def __init__(self, filename="log.csv", threaded=True, autoFlush=1, parent=None, **fmtparams):
+    def __init__(self, filename="log.csv", threaded=True, autoFlush=1, flushRows=None, parent=None, **fmtparams):
         super().__init__(parent=parent)
         self.logger = logging.getLogger(__name__)
         self._fmtparams = fmtparams
         self._filename = filename
         self._objects = set()
+        # Objects and their names, kept sorted by name.
+        self._sortedObjects = []
+        self._sortedNames = []
         self._csv = None
+        self._fmt = None
         self._file = None
+        self._text = None
+        # Flush interval in seconds, and the number of rows that forces a
+        # flush earlier. None disables either of them.
         self._autoFlushInterval = autoFlush
         self._autoFlushed = time.time()
+        self._flushRows = flushRows
+        self._unflushedRows = 0
         self._thread = None
         self._queue = None
-        self._dropNext = False
+        self._wakeup = None
+        self._epoch = 0
+        self._dirty = False
+        self._closed = False
 
         self.logger.info('Writing samples to %s...', self._filename)
         self._lock = threading.RLock()
+        if threaded:
+            # Samples are appended by write() and drained in batches by the
+            # worker. deque.append() and popleft() are atomic, no lock needed.
+            self._queue = collections.deque()
+            self._wakeup = threading.Event()
         self.restart()
         if threaded:
-            self._queue = queue.Queue()
             self._thread = threading.Thread(target=self._worker)
             self._thread.daemon = True
             self._thread.start()
 
     def _clear(self):
-        if self._queue == None:
-            return
-
-        try:
-            self._queue.get(False)
-        except queue.Empty:
-            pass
-
-        self._dropNext = True
+        # All samples that are still queued belong to the previous epoch.
+        # Drop them at once by swapping the queue. Samples that the worker
+        # already took are filtered on their epoch.
+        self._epoch += 1
+        if self._queue != None:
+            self._queue = collections.deque()
 
     def add(self, o):
         if o in self._objects:
             return
 
         self._objects.add(o)
-        self.restart()
+        i = bisect.bisect(self._sortedNames, o.name)
+        self._sortedNames.insert(i, o.name)
+        self._sortedObjects.insert(i, o)
+        self._scheduleRestart()
 
     def remove(self, o):
         if not o in self._objects:
             return
 
         self._objects.remove(o)
-        self.restart()
+        i = self._sortedObjects.index(o)
+        del self._sortedNames[i]
+        del self._sortedObjects[i]
+        self._scheduleRestart()
+
+    def _scheduleRestart(self):
+        if QThread.currentThread().loopLevel() == 0:
+            # No event loop is running, which would handle a deferred restart.
+            self.restart()
+        elif not self._dirty:
+            # Coalesce multiple changes in the set of objects into one restart.
+            self._dirty = True
+            QTimer.singleShot(0, self._restartIfDirty)
+
+    @Slot()
+    def _restartIfDirty(self):
+        if self._dirty:
+            self.restart()
 
     def restart(self):
         self._lock.acquire()
-        objList = sorted(self._objects, key=lambda x: x.name)
-        if self._file != None:
-            self._file.close()
-        self._file = open(self._filename, 'w', newline='')
-        self._csv = csv.writer(self._file, **self._fmtparams)
-        self._objValues = [lambda x=x: x._value for x in objList]
-        self._csv.writerow(['t'] + [x.name for x in objList])
+        self._dirty = False
+        if self._closed:
+            self._lock.release()
+            return
+        # The set is only used for membership tests; keep the sorted objects
+        # in a tuple, which is what is iterated afterwards.
+        objList = tuple(self._sortedObjects)
+        if self._text != None:
+            self._text.close()
+        # Numeric rows are written as bytes directly into the buffered file.
+        # Only the csv writer goes through a text layer, which passes its
+        # output immediately to the same buffer.
+        self._file = open(self._filename, 'wb', buffering=1 << 20)
+        self._text = io.TextIOWrapper(self._file, encoding='utf-8', newline='', write_through=True)
+        self._unflushedRows = 0
+        self._csv = csv.writer(self._text, **self._fmtparams)
+        self._objList = objList
+        if self._fmtparams == {} and all(o.isFixed() for o in objList):
+            # Only numbers, which do not need quoting. Bypass the csv writer.
+            # %a formats like repr(), which is what csv would write too.
+            self._fmt = b'%a' + b',%a' * len(objList) + b'\r\n'
+        else:
+            self._fmt = None
+        self._csv.writerow(('t', *(x.name for x in objList)))
         self._clear()
+        self.write = self._compileWrite()
         self._lock.release()
 
-    def write(self, t=None):
-        now = time.time()
-        if t == None:
-            t = now
-
-        data = [t]
-        data.extend(map(lambda x: x(), self._objValues))
+    def _compileWrite(self):
+        # Generate a write() function that is specialized for the current set
+        # of objects and epoch. This saves a lot of overhead per sample.
+        ns = {'time': time.time}
+        values = ''
+        for i, o in enumerate(self._objList):
+            ns[f'o{i}'] = o
+            values += f' o{i}._value,'
 
         if self._queue == None:
-            self._write(data)
+            ns['_write'] = self._write
+            store = f'_write(((t,{values}),))'
         else:
-            self._queue.put(data)
+            ns['append'] = self._queue.append
+            ns['is_set'] = self._wakeup.is_set
+            ns['wakeup'] = self._wakeup.set
+            store = \
+                f'append(({self._epoch}, (t,{values})))\n' + \
+                f'    if not is_set():\n' + \
+                f'        wakeup()'
+
+        exec(
+            f'def write(t=None):\n' + \
+            f'    if t == None:\n' + \
+            f'        t = time()\n' + \
+            f'    {store}\n',
+            ns)
+        return ns['write']
+
+    def write(self, t=None):
+        # Replaced by restart().
+        pass
 
-    def _write(self, data):
+    def _write(self, rows):
         if self._file == None:
             return
 
-        self._csv.writerow(data)
-
-        if self._autoFlushInterval != None:
+        if self._fmt == None:
+            self._csv.writerows(rows)
+        else:
+            # Format all rows in one go, without a Python loop.
+            s = b''.join(map(self._fmt.__mod__, rows))
+            if not b'None' in s:
+                self._file.write(s)
+            else:
+                # As only numbers are written, 'None' can only come from objects
+                # that were not read yet. Let csv leave these fields empty.
+                for data in rows:
+                    if None in data:
+                        self._csv.writerow(data)
+                    else:
+                        self._file.write(self._fmt % data)
+
+        self._unflushedRows += len(rows)
+        if self._flushRows != None and self._unflushedRows >= self._flushRows:
+            self._flush()
+        elif self._autoFlushInterval != None:
             now = time.time()
             if self._autoFlushed + self._autoFlushInterval <= now:
-                self._file.flush()
-                self._autoFlushed = now
+                self._flush(now)
+
+    def _flush(self, now=None):
+        self._file.flush()
+        self._unflushedRows = 0
+        self._autoFlushed = time.time() if now == None else now
+
+    def flush(self):
+        self._lock.acquire()
+        if self._queue != None:
+            # Write the samples that the worker did not take yet.
+            self._drain()
+        if self._file != None:
+            self._flush()
+        self._lock.release()
+
+    def close(self):
+        self._lock.acquire()
+        self.flush()
+        # Samples are dropped from now on, and the file is not reopened.
+        self._closed = True
+        if self._text != None:
+            self._text.close()
+        self._text = None
+        self._file = None
+        self._lock.release()
 
     def _worker(self):
         while True:
-            d = self._queue.get()
+            self._wakeup.wait()
+            self._wakeup.clear()
+
             self._lock.acquire()
-            if self._dropNext:
-                self._dropNext = False
-            else:
-                self._write(d)
+            self._drain()
             self._lock.release()
 
+    def _drain(self):
+        # Take all samples that are queued right now.
+        q = self._queue
+        batch = [q.popleft() for _ in range(len(q))]
+
+        # Stale samples of a previous epoch are dropped.
+        epoch = self._epoch
+        rows = [d for e, d in batch if e == epoch]
+        if rows != []:
+            self._write(rows)
+
@@ -22,7 +22,8 @@ import logging
 
 from PySide2.QtGui import QGuiApplication, QIcon
 from PySide2.QtQml import QQmlApplicationEngine
-from PySide2.QtCore import QUrl, QAbstractListModel, QModelIndex, Qt, Slot, QSortFilterProxyModel, QCoreApplication
+from PySide2.QtCore import QUrl, QAbstractListModel, QModelIndex, Qt, Slot, QSortFilterProxyModel, QCoreApplication, \
+    QObject, QTimer
 
 from lognplot.client import LognplotTcpClient
 
@@ -33,17 +34,31 @@ from ..csv import generateFilename
 class NatSort(QSortFilterProxyModel):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
+        self._keygen = None
+        self._keygenCaseSensitivity = None
+        self._keys = {}
+
+    def _key(self, data):
+        caseSensitivity = self.sortCaseSensitivity()
+        if self._keygen == None or self._keygenCaseSensitivity != caseSensitivity:
+            alg = natsort.ns.REAL | natsort.ns.LOCALE
+            if caseSensitivity == Qt.CaseInsensitive:
+                alg = alg | natsort.ns.IGNORECASE
+            self._keygen = natsort.natsort_keygen(alg=alg)
+            self._keygenCaseSensitivity = caseSensitivity
+            self._keys = {}
+
+        # Tokenize every string only once, not for every comparison.
+        try:
+            return self._keys[data]
+        except KeyError:
+            key = self._keys[data] = self._keygen(data)
+            return key
 
     def lessThan(self, left, right):
         left_data = self.sourceModel().data(left, role=self.sortRole())
         right_data = self.sourceModel().data(right, role=self.sortRole())
-
-        alg = natsort.ns.REAL | natsort.ns.LOCALE
-        if self.sortCaseSensitivity() == Qt.CaseInsensitive:
-            alg = alg | natsort.ns.IGNORECASE
-
-        sorted_data = natsort.natsorted([left_data, right_data], alg=alg)
-        return left_data == sorted_data[0]
+        return self._key(left_data) < self._key(right_data)
 
 class ObjectListModel(QAbstractListModel):
     NameRole = Qt.UserRole + 1000
@@ -53,10 +68,15 @@ class ObjectListModel(QAbstractListModel):
     def __init__(self, objects, parent=None):
         super().__init__(parent)
         self._objects = objects
-        for i in range(0, len(objects)):
-            objects[i].pollingChanged.connect(lambda i=i: self._pollingChanged(i))
-
-    def _pollingChanged(self, i):
+        self._indexOf = {o: i for i, o in enumerate(objects)}
+        for o in objects:
+            o.pollingChanged.connect(self._pollingChanged)
+
+    @Slot()
+    def _pollingChanged(self):
+        i = self._indexOf.get(self.sender())
+        if i == None:
+            return
         index = self.createIndex(i, 0)
         self.dataChanged.emit(index, index, [self.PollingRole])
 
@@ -89,21 +109,51 @@ class ObjectListModel(QAbstractListModel):
             self.PollingRole: b'polling',
         }
 
-def lognplot_send(lognplot, o):
-    if not o.polling:
-        return
-    if not o.isFixed():
-        # Not supported
-        return
-
-    try:
-        lognplot.send_sample(o.name, o.t, float(o.value))
-    except ConnectionResetError:
-        print(f'Reconnecting to lognplot...')
+class LognplotSender(QObject):
+    """Collect samples of polled objects, and forward them in batches to lognplot."""
+
+    def __init__(self, lognplot, objects, interval_s=0.1, parent=None):
+        super().__init__(parent=parent)
+        self._lognplot = lognplot
+        self._samples = {}
+
+        for o in objects:
+            if o.isFixed():
+                o.valueUpdated.connect(self._sample)
+
+        self._timer = QTimer(parent=self)
+        self._timer.timeout.connect(self._send)
+        self._timer.setInterval(interval_s * 1000)
+        self._timer.setSingleShot(False)
+        self._timer.start()
+
+    @Slot()
+    def _sample(self):
+        o = self.sender()
+        if not o.polling or o.value == None:
+            return
+
         try:
-            lognplot.connect()
-        except:
-            pass
+            self._samples[o.name].append((o.t, float(o.value)))
+        except KeyError:
+            self._samples[o.name] = [(o.t, float(o.value))]
+
+    def _send(self):
+        if self._samples == {}:
+            return
+
+        samples = self._samples
+        self._samples = {}
+
+        try:
+            for name, batch in samples.items():
+                self._lognplot.send_sample_batch(name, batch)
+        except ConnectionResetError:
+            print(f'Reconnecting to lognplot...')
+            try:
+                self._lognplot.connect()
+            except:
+                pass
 
 
 
@@ -165,9 +215,7 @@ if __name__ == '__main__':
         print(f'Connecting to lognplot at {args.lognplot}:{args.lognplotport}...')
         lognplot = LognplotTcpClient(args.lognplot, args.lognplotport)
         lognplot.connect()
-        for o in client.objects:
-            if o.isFixed():
-                o.valueUpdated.connect(lambda o=o: lognplot_send(lognplot, o))
+        lognplotSender = LognplotSender(lognplot, client.objects, parent=app)
 
     engine.load(QUrl.fromLocalFile(os.path.join(os.path.dirname(os.path.realpath(__file__)), "gui_client.qml")))
     if not engine.rootObjects():
@@ -16,10 +16,15 @@
 
 import logging
 import crcmod
+import re
 import sys
 import time
 import struct
 
+# All single-byte bytes objects, indexed by value.
+_byte = tuple(bytes([b]) for b in range(0, 0x100))
+_be_uint16 = struct.Struct('>H')
+
 class ProtocolLayer:
     name = 'layer'
 
@@ -28,12 +33,38 @@ class ProtocolLayer:
         self._up = None
         self._down_callback = None
         self._up_callback = None
+        # The functions to pass encoded/decoded data to, which combine the
+        # callback and the adjacent layer. They are updated when either changes.
+        self._encodeNext = self._drop
+        self._decodeNext = self._drop
         self._activity = 0
         self.logger = logging.getLogger(__name__)
 
+    @staticmethod
+    def _drop(data):
+        pass
+
+    @staticmethod
+    def _next(callback, layerFun):
+        if callback is None:
+            return ProtocolLayer._drop if layerFun is None else layerFun
+        elif layerFun is None:
+            return callback
+        else:
+            def both(data):
+                callback(data)
+                layerFun(data)
+            return both
+
+    def _updateNext(self):
+        self._encodeNext = self._next(self._down_callback, None if self._down is None else self._down.encode)
+        self._decodeNext = self._next(self._up_callback, None if self._up is None else self._up.decode)
+
     def wrap(self, layer):
         layer._down = self
+        layer._updateNext()
         self._up = layer
+        self._updateNext()
 
     @property
     def up(self):
@@ -42,6 +73,7 @@ class ProtocolLayer:
     @up.setter
     def up(self, cb):
         self._up_callback = cb
+        self._updateNext()
 
     @property
     def down(self):
@@ -50,79 +82,102 @@ class ProtocolLayer:
     @down.setter
     def down(self, cb):
         self._down_callback = cb
+        self._updateNext()
 
     def encode(self, data):
-        if self._down_callback != None:
-            self._down_callback(data)
-        if self.down != None:
-            self.down.encode(data)
+        self._encodeNext(data)
 
     def decode(self, data):
-        if self._up_callback != None:
-            self._up_callback(data)
-        if self.up != None:
-            self.up.decode(data)
+        self._decodeNext(data)
 
     @property
     def mtu(self):
-        if self.down != None:
-            return self.down.mtu
+        down = self._down
+        if down is not None:
+            return down.mtu
         else:
             return 0
 
     def timeout(self):
-        if self.down != None:
-            self.down.timeout()
+        down = self._down
+        if down is not None:
+            down.timeout()
 
     def activity(self):
         self._activity = time.time()
 
     def lastActivity(self):
         a = 0
-        if self.down != None:
-            a = self.down.lastActivity()
+        down = self._down
+        if down is not None:
+            a = down.lastActivity()
 
         return max(a, self._activity)
 
 class AsciiEscapeLayer(ProtocolLayer):
     name = 'ascii'
 
+    # Bytes that do not need escaping.
+    _plain = bytes(range(0x20, 0x7f)) + bytes(range(0x80, 0x100))
+    # Bytes that need escaping, and their encoding.
+    _escape = re.compile(b'[\x00-\x1f\x7f]')
+    _encodeTable = {
+        _byte[b]: b'\x7f\x7f' if b == 0x7f else bytes([0x7f, b | 0x40])
+        for b in list(range(0, 0x20)) + [0x7f]}
+    # Decoding of the byte following an escape.
+    _decodeTable = [_byte[0x7f if b == 0x7f else b & 0x3f] for b in range(0, 0x100)]
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
     def decode(self, data):
-        res = bytearray()
-        esc = False
-        for b in data:
-            if esc:
-                if b == 0x7f:
-                    res.append(0x7f)
-                else:
-                    res.append(b & 0x3f)
-                esc = False
-            elif b == 0x7f:
-                esc = True
+        if isinstance(data, memoryview):
+            # Neither the search nor split() below work on a memoryview.
+            data = bytes(data)
+
+        if b'\x7f' not in data:
+            # Nothing escaped.
+            self.activity()
+            super().decode(data)
+            return
+
+        # Every part, except the first one, was preceded by an escape.
+        parts = iter(data.split(b'\x7f'))
+        res = [next(parts)]
+        append = res.append
+        for p in parts:
+            if p:
+                append(self._decodeTable[p[0]])
+                append(p[1:])
             else:
-                res.append(b)
+                # Escaped 0x7f, which consumed the next separator.
+                # A dangling escape at the end is dropped.
+                p = next(parts, None)
+                if p is not None:
+                    append(b'\x7f')
+                    append(p)
 
         self.activity()
-        super().decode(res)
+        super().decode(b''.join(res))
+
+    @staticmethod
+    def _encodeMatch(m):
+        return AsciiEscapeLayer._encodeTable[m[0]]
 
     def encode(self, data):
         if isinstance(data, str):
             data = data.encode()
+        elif isinstance(data, memoryview):
+            data = bytes(data)
 
-        res = bytearray()
+        # Deleting all plain bytes leaves the ones to escape. Pass the data
+        # through as is when there are none.
+        if data.translate(None, self._plain):
+            # Only the bytes to escape are handled in Python; the runs of
+            # plain bytes in between are copied by the regex engine.
+            data = self._escape.sub(self._encodeMatch, data)
 
-        for b in data:
-            if b < 0x20:
-                res += bytearray([0x7f, b | 0x40])
-            elif b == 0x7f:
-                res += bytearray([0x7f, 0x7f])
-            else:
-                res.append(b)
-
-        super().encode(res)
+        super().encode(data)
         self.activity()
 
     @property
@@ -152,6 +207,7 @@ class TerminalLayer(ProtocolLayer):
             self.fdout = fdout
 
         self._data = bytearray()
+        self._scanned = 0
         self._inMsg = False
         self._ignoreEscape = ignoreEscapesTillFirstEncode
 
@@ -164,7 +220,7 @@ class TerminalLayer(ProtocolLayer):
             data = data.encode()
 
         self._ignoreEscape = False
-        super().encode(self.start + data + self.end)
+        super().encode(b''.join((self.start, data, self.end)))
         self.activity()
 
     # Encode non-debug message
@@ -182,41 +238,65 @@ class TerminalLayer(ProtocolLayer):
             self.nonDebugData(data)
             return
 
+        start = self.start
+        if not self._inMsg and not self._data and data[-1] != start[0] \
+            and start not in data:
+            # Only non-debug data, which does not have to be buffered.
+            self.nonDebugData(data)
+            return
+
         self._data += data
 
-        if data[-1] == self.start[0]:
+        if data[-1] == start[0]:
             # Got partial escape code. Wait for more data.
             return
 
+        # Process the buffer from offset pos, and only drop the processed
+        # data once, at the end.
+        buf = self._data
+        find = buf.find
+        end = self.end
+        nonDebugData = self.nonDebugData
+        pos = 0
+
         while True:
             if not self._inMsg:
-                c = self._data.split(self.start, 1)
-                if c[0] != b'':
-                    self.nonDebugData(c[0])
-
-                if len(c) == 1:
+                i = find(start, pos)
+                if i < 0:
                     # No start of message in here.
-                    self._data = bytearray()
-                    return
-                else:
-                    # Keep rest of data, and continue decoding.
-                    self._data = c[1]
-                    self._inMsg = True
+                    nonDebugData(buf[pos:])
+                    pos = len(buf)
+                    break
+
+                nonDebugData(buf[pos:i])
+                # Continue decoding after the start.
+                pos = i + len(start)
+                self._scanned = pos
+                self._inMsg = True
             else:
-                c = self._data.split(self.end, 1)
-                if len(c) == 1:
+                # Do not search again through the data we had before.
+                i = find(end, max(pos, self._scanned))
+                if i < 0:
                     # No end of message in here. Wait for more.
-                    return
-                else:
-                    # Got a full message.
-                    # Remove \r as they can be inserted automatically by Windows.
-                    # If \r is meant to be sent, escape it.
-                    msg = c[0].replace(b'\r', b'')
-                    self.logger.debug('extracted ' + str(bytes(msg)))
-                    self.activity()
-                    super().decode(msg)
-                    self._data = c[1]
-                    self._inMsg = False
+                    self._scanned = max(pos, len(buf) - len(end) + 1)
+                    break
+
+                # Got a full message.
+                # Remove \r as they can be inserted automatically by Windows.
+                # If \r is meant to be sent, escape it.
+                msg = buf[pos:i]
+                if find(b'\r', pos, i) >= 0:
+                    msg = msg.translate(None, b'\r')
+                if self.logger.isEnabledFor(logging.DEBUG):
+                    self.logger.debug('extracted %r', bytes(msg))
+                self.activity()
+                super().decode(msg)
+                pos = i + len(end)
+                self._inMsg = False
+
+        if pos > 0:
+            del buf[:pos]
+            self._scanned = max(0, self._scanned - pos)
 
     @property
     def mtu(self):
@@ -233,15 +313,19 @@ class SegmentationLayer(ProtocolLayer):
     def __init__(self, mtu=None, **kwargs):
         super().__init__(**kwargs)
         self._mtu = None if mtu == None else int(mtu)
-        self._buffer = bytearray()
+        # The received segments, without their end/continuation marker.
+        self._buffer = []
 
     def decode(self, data):
-        self._buffer += data[:-1]
+        self._buffer.append(memoryview(data)[:-1])
         self.activity()
         if data[-1:] == self.end:
-            self.logger.debug('reassembled ' + str(bytes(self._buffer)))
-            super().decode(self._buffer)
-            self._buffer = bytearray()
+            # Copy all segments only once, when the message is complete.
+            msg = b''.join(self._buffer)
+            self._buffer = []
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('reassembled %r', bytes(msg))
+            super().decode(msg)
 
     def encode(self, data):
         mtu = self._mtu
@@ -249,18 +333,19 @@ class SegmentationLayer(ProtocolLayer):
             mtu = super().mtu
         if mtu == 0:
             super().encode(data + self.end)
-        else:
+        elif len(data) > 0:
             mtu = max(1, mtu - 1)
-            for i in range(0, len(data), mtu):
-                if i + mtu >= len(data):
-                    super().encode(data[i:i+mtu] + self.end)
-                else:
-                    super().encode(data[i:i+mtu] + self.cont)
+            # Slice the data without copying; only the joined segments are allocated.
+            view = memoryview(data)
+            last = (len(data) - 1) // mtu * mtu
+            for i in range(0, last, mtu):
+                super().encode(b''.join((view[i:i+mtu], self.cont)))
+            super().encode(b''.join((view[last:], self.end)))
         self.activity()
 
     def timeout(self):
         # A retransmit is pending. Clear partial data.
-        self._buffer = bytearray()
+        self._buffer = []
         super().timeout()
 
     @property
@@ -274,7 +359,9 @@ class DebugArqLayer(ProtocolLayer):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._req = False
-        self._request = []
+        # All chunks of the current request, back to back, with the offset of every chunk.
+        self._request = bytearray()
+        self._requestOffsets = []
         self._reset = True
         self._syncing = False
         self._decode_seq = 1
@@ -286,7 +373,8 @@ class DebugArqLayer(ProtocolLayer):
             return
 
         (seq, msg) = self.decode_seq(data)
-        if data[0] & self.reset_flag:
+        hdr = data[0]
+        if hdr & self.reset_flag:
             self._decode_seq = seq
 
         if self._req:
@@ -296,49 +384,50 @@ class DebugArqLayer(ProtocolLayer):
             self._decode_seq_start = self._decode_seq
 
         if seq == self._decode_seq:
-            self._decode_seq = self.nextSeq(self._decode_seq)
+            self._decode_seq = self.nextSeq(seq)
             if len(msg) > 0:
                 self.activity()
                 super().decode(msg)
         else:
             self.logger.debug(f'unexpected seq {seq} instead of {self._decode_seq}; dropped')
 
-        if self._syncing and data[0] == self.reset_flag:
+        if self._syncing and hdr == self.reset_flag:
             self._syncing = False
-            for r in self._request:
-                super().encode(r)
+            self._resend()
             self.activity()
 
     def decode_seq(self, data):
-        seq = 0
         if len(data) == 0:
             raise ValueError
-        seq = data[0] & 0x3f
-        if data[0] & 0x40:
-            if len(data) == 1:
-                raise ValueError
-            seq = (seq << 7) | data[1] & 0x7f
-            if data[1] & 0x80:
-                if len(data) == 2:
-                    raise ValueError
-                seq = (seq << 7) | data[2] & 0x7f
-                if data[2] & 0x80:
-                    if len(data) == 3:
-                        raise ValueError
-                    seq = (seq << 7) | data[3] & 0x7f
-                    if data[3] & 0x80:
-                        raise ValueError
-                    return (seq, data[4:])
-                else:
-                    return (seq, data[3:])
-            else:
-                return (seq, data[2:])
-        else:
-            return (seq, data[1:])
+
+        seq = data[0]
+        if not seq & 0x40:
+            # Single-byte seq, which is the common case.
+            return (seq & 0x3f, data[1:])
+
+        seq &= 0x3f
+        if len(data) == 1:
+            raise ValueError
+        seq = (seq << 7) | data[1] & 0x7f
+        if not data[1] & 0x80:
+            return (seq, data[2:])
+
+        if len(data) == 2:
+            raise ValueError
+        seq = (seq << 7) | data[2] & 0x7f
+        if not data[2] & 0x80:
+            return (seq, data[3:])
+
+        if len(data) == 3:
+            raise ValueError
+        seq = (seq << 7) | data[3] & 0x7f
+        if data[3] & 0x80:
+            raise ValueError
+        return (seq, data[4:])
 
     def encode_seq(self, seq):
         if seq < 0x40:
-            return bytes([seq & 0x3f])
+            return _byte[seq]
         if seq < 0x2000:
             return bytes([
                 0x40 | ((seq >> 7) & 0x3f),
@@ -362,7 +451,8 @@ class DebugArqLayer(ProtocolLayer):
             self._sync()
 
         if not self._req:
-            self._request = []
+            self._request = bytearray()
+            self._requestOffsets = []
 #            if self._encode_seq >= 0x2000:
 #                # Try to keep the seq value low.
 #                self._sync()
@@ -372,13 +462,17 @@ class DebugArqLayer(ProtocolLayer):
         self._encode_seq = self.nextSeq(self._encode_seq)
 
         # We cannot handle a wrap around of the seq, as a retransmit will be bogus.
-        # Make sure the MTU is big enough to transmit the full request in 255 chunks.
+        # The seq has 27 bits, so a single request cannot realistically get there.
+        # Like any assert, this check is removed when running with -O.
         assert self._encode_seq != self._encode_seq_start
 
-        request = self.encode_seq(self._encode_seq) + data
-        self._request.append(request)
+        # Append the chunk to the request in place, and only take a copy to pass down.
+        offset = len(self._request)
+        self._requestOffsets.append(offset)
+        self._request += self.encode_seq(self._encode_seq)
+        self._request += data
         if not self._syncing:
-            super().encode(request)
+            super().encode(self._request[offset:])
             self.activity()
 
     def _sync(self):
@@ -386,7 +480,7 @@ class DebugArqLayer(ProtocolLayer):
             return
         self._syncing = True
         self._encode_seq = 0
-        super().encode(bytes([self.reset_flag]))
+        super().encode(_byte[self.reset_flag])
 
     def timeout(self):
         super().timeout()
@@ -396,19 +490,27 @@ class DebugArqLayer(ProtocolLayer):
 
     def reset(self):
         self._reset = True
-        self._request = []
+        self._request = bytearray()
+        self._requestOffsets = []
 
     def retransmit(self):
         self.logger.debug('retransmit')
         if self._syncing:
-            super().encode(bytes([self.reset_flag]))
+            super().encode(_byte[self.reset_flag])
         else:
-            for r in self._request:
-                super().encode(r)
+            self._resend()
+
+    def _resend(self):
+        request = self._request
+        offsets = self._requestOffsets
+        for i in range(0, len(offsets) - 1):
+            super().encode(request[offsets[i]:offsets[i + 1]])
+        if offsets != []:
+            super().encode(request[offsets[-1]:])
 
     def nextSeq(self, seq):
-        seq = (seq + 1) % 0x8000000
-        return 1 if seq == 0 else seq
+        # seq 0 is skipped, as it is only used for a reset.
+        return seq + 1 if seq < 0x7ffffff else 1
 
     @property
     def mtu(self):
@@ -422,23 +524,28 @@ class Crc8Layer(ProtocolLayer):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # crcmod evaluates the table in its C extension, when available.
         self._crc = crcmod.mkCrcFun(0x1a6, 0xff, False, 0)
 
     def encode(self, data):
-        super().encode(data + bytes([self.crc(data)]))
+        super().encode(data + _byte[self._crc(data)])
         self.activity()
 
     def decode(self, data):
         if len(data) == 0:
             return
 
-        if self.crc(data[0:-1]) != data[-1]:
+        # Note that the polynomial does not have the x^0 term, so the CRC over
+        # the data including the appended CRC is not necessarily 0 when valid.
+        payload = data[0:-1]
+        if self._crc(payload) != data[-1]:
 #            self.logger.debug('invalid CRC, dropped ' + str(bytes(data)))
             return
 
-        self.logger.debug('valid CRC ' + str(bytes(data)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('valid CRC %r', bytes(data))
         self.activity()
-        super().decode(data[0:-1])
+        super().decode(payload)
 
     def crc(self, data):
         return self._crc(data)
@@ -456,21 +563,24 @@ class Crc16Layer(ProtocolLayer):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        # crcmod evaluates the table in its C extension, when available.
         self._crc = crcmod.mkCrcFun(0x1baad, 0xffff, False, 0)
 
     def encode(self, data):
-        super().encode(data + struct.pack('>H', self.crc(data)))
+        super().encode(data + _be_uint16.pack(self._crc(data)))
         self.activity()
 
     def decode(self, data):
         if len(data) < 2:
             return
 
-        if self.crc(data[0:-2]) != struct.unpack('>H', data[-2:])[0]:
+        # The CRC over the data, including the appended CRC, is 0 when valid.
+        if self._crc(data) != 0:
 #            self.logger.debug('invalid CRC, dropped ' + str(bytes(data)))
             return
 
-        self.logger.debug('valid CRC ' + str(bytes(data)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('valid CRC %r', bytes(data))
         self.activity()
         super().decode(data[0:-2])
 
@@ -497,6 +607,9 @@ class ProtocolStack(ProtocolLayer):
         self._layers[0].up = super().decode
 
     def encode(self, data):
+        # Only the stack accepts str; the layers themselves expect bytes.
+        if isinstance(data, str):
+            data = data.encode()
         self._layers[0].encode(data)
 
     def decode(self, data):
@@ -568,8 +681,12 @@ layer_types = [
     RawLayer,
 ]
 
+# Index of layer_types by name. The first registered type of a name wins.
+_layer_types_by_name = {lt.name: lt for lt in reversed(layer_types)}
+
 def registerLayerType(layer_type):
     layer_types.append(layer_type)
+    _layer_types_by_name.setdefault(layer_type.name, layer_type)
 
 def buildStack(description):
     """Construct the protocol stack from a description.
@@ -593,11 +710,8 @@ def buildStack(description):
         if name_arg[0] == '':
             raise ValueError(f'Missing layer type')
 
-        for lt in layer_types:
-            if name_arg[0] == lt.name:
-                layer_type = lt
-                break
-        else:
+        layer_type = _layer_types_by_name.get(name_arg[0])
+        if layer_type == None:
             raise ValueError(f'Unknown layer type {name_arg[0]}')
 
         if len(name_arg) == 2:
@@ -34,12 +34,16 @@ class Serial2Zmq(Stream2Zmq):
         self.logger = logging.getLogger(__name__)
 
         self._drop = None
-        self._bufferStdin = b''
+        self._bufferStdin = bytearray()
         if not drop_s is None:
             self._drop = time.time() + drop_s
 
     def poll(self, timeout_s = None):
         dropping = not self._drop is None
+        if dropping:
+            # Wake up when the drop period ends, to forward the queued stdin.
+            remaining = max(0, self._drop - time.time())
+            timeout_s = remaining if timeout_s is None else min(timeout_s, remaining)
 
         events = super().poll(timeout_s)
 
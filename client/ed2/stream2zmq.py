@@ -42,6 +42,10 @@ class InfiniteStdoutBuffer:
         self._queue = queue.Queue()
         self._closed = False
         self._cleanup = cleanup
+        # bytes are written to the underlying binary stream, if there is one.
+        self._buffer = getattr(stdout, 'buffer', None)
+        self._lineBuffering = getattr(stdout, 'line_buffering', False)
+        self._textPending = False
         self._thread = threading.Thread(target=self._worker)
         self._thread.daemon = True
         self._thread.start()
@@ -54,7 +58,19 @@ class InfiniteStdoutBuffer:
 
     def _write(self, data):
         # This may block.
-        self.stdout.write(data)
+        if isinstance(data, str):
+            self.stdout.write(data)
+            self._textPending = True
+        elif self._buffer == None:
+            self.stdout.write(data.decode(errors="replace"))
+        else:
+            if self._textPending:
+                # Keep the order with text that is still buffered.
+                self.stdout.flush()
+                self._textPending = False
+            self._buffer.write(data)
+            if self._lineBuffering:
+                self._buffer.flush()
 
     def flush(self):
         self._queue.join()
@@ -88,11 +104,12 @@ def resetStdout(old_stdout):
 
 def setInfiniteStdout():
     if isinstance(sys.stdout, InfiniteStdoutBuffer):
-        return
+        return sys.stdout
     sys.stdout.flush()
     old_stdout = sys.stdout
     set_blocking(old_stdout)
     sys.stdout = InfiniteStdoutBuffer(old_stdout, lambda: resetStdout(old_stdout))
+    return sys.stdout
 
 class Stream2Zmq(protocol.ProtocolLayer):
     """A generic out-of-band frame grabber for ASCII streams."""
@@ -105,7 +122,7 @@ class Stream2Zmq(protocol.ProtocolLayer):
         self._stack_def = f'zmq={listen}:{port},' + stack
         self._timeout_s = timeout_s
         self._zmq = None
-        setInfiniteStdout()
+        self._stdout = setInfiniteStdout()
         self.reset()
 
     def reset(self):
@@ -114,21 +131,25 @@ class Stream2Zmq(protocol.ProtocolLayer):
             if isinstance(l, protocol.TerminalLayer):
                 l.fdout = self.stdout
         self.wrap(self._stack)
-        self._zmq = None
+        # The zmq layer is always the top of the stack.
+        self._zmq = next(iter(self._stack))
 
     def encode(self, data):
-        self.logger.debug('encode ' + str(bytes(data)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('encode %r', bytes(data))
         super().encode(data)
 
     def decode(self, data):
-        self.logger.debug('decode ' + str(bytes(data)))
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug('decode %r', bytes(data))
         super().decode(data)
 
     def timeout(self):
         self._stack.timeout()
 
     def stdout(self, data):
-        sys.stdout.write(data.decode(errors="replace"))
+        # Forward the bytes as is; there is no need to decode them.
+        self._stdout.write(data)
 
     def isWaiting(self):
         return self.zmq.isWaiting()
@@ -136,16 +157,17 @@ class Stream2Zmq(protocol.ProtocolLayer):
     def poll(self, timeout_s = None):
         self.logger.debug('poll')
 
-        if self.isWaiting():
+        server = self._zmq
+        if server.isWaiting():
             if timeout_s == None:
                 timeout_s = self._timeout_s
-            remaining = self.zmq.lastActivity() + self._timeout_s - time.time()
+            remaining = server.lastActivity() + self._timeout_s - time.time()
             if remaining <= 0:
                 self.timeout()
             else:
                 timeout_s = min(timeout_s, remaining)
 
-        return self.zmq.poll(timeout_s)
+        return server.poll(timeout_s)
 
     def recvAll(self, socket, f):
         try:
@@ -163,9 +185,6 @@ class Stream2Zmq(protocol.ProtocolLayer):
 
     @property
     def zmq(self):
-        if self._zmq == None:
-            # Cache the zmq layer.
-            self._zmq = next(iter(self._stack))
         return self._zmq
 
     def close(self):
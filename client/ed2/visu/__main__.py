@@ -19,6 +19,7 @@ import argparse
 import os
 import logging
 import importlib.util
+import importlib.machinery
 
 from PySide2.QtGui import QGuiApplication
 from PySide2.QtQml import QQmlApplicationEngine
@@ -71,7 +72,10 @@ if __name__ == '__main__':
     engine = QQmlApplicationEngine(parent=app)
     engine.rootContext().setContextProperty("client", client)
 
-    spec = importlib.util.spec_from_file_location("visu_rcc", args.rcc[0])
+    # The source loader caches the compiled rcc module in __pycache__, like any
+    # imported module, regardless of the file's extension.
+    loader = importlib.machinery.SourceFileLoader("visu_rcc", args.rcc[0])
+    spec = importlib.util.spec_from_file_location("visu_rcc", args.rcc[0], loader=loader)
     visu_rcc = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(visu_rcc)
 
@@ -15,6 +15,7 @@
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
 
 import zmq
+import binascii
 import time
 import datetime
 import struct
@@ -33,6 +34,16 @@ from PySide2.QtCore import QObject, Signal, Slot, Property, QTimer, Qt, \
 from .zmq_server import ZmqServer
 from .csv import CsvExport
 
+# Precompiled packers for the float codecs.
+_be_float = struct.Struct('>f')
+_be_double = struct.Struct('>d')
+
+# Hex representation of all byte values.
+_hexByte = tuple('%02x' % b for b in range(0, 0x100))
+
+def _bytesString(data):
+    return ' '.join([_hexByte[b] for b in data])
+
 # Wrapper to keep sphinx happy...
 class _Property(Property):
     def __init__(self, *args, **kwargs):
@@ -85,16 +96,37 @@ class Object(QObject):
     def __init__(self, name, type, size, client=None):
         super().__init__(parent=client)
         self._name = name
+        self._nameBytes = name.encode()
         self._type = type
+        self._dtype = type & ~self.FlagFunction
+        flags = self._typeFlags[type]
+        self._isValidType = flags & self._ValidType != 0
+        self._isFunction = flags & self._Function != 0
+        self._isFixed = flags & self._Fixed != 0
+        self._isInt = flags & self._Int != 0
+        self._isSigned = flags & self._Signed != 0
+        self._isSpecial = flags & self._Special != 0
+        self._signedSize = self._signedSizeByType.get(self._dtype)
         self._size = size
+        if self._isInt:
+            self._decoder = self._decodeInt if self._isSigned else self._decodeFixed
+            self._encoder = self._encodeInt
+        else:
+            self._decoder = getattr(self, self._decoders.get(self._dtype, '_decodeInvalid'))
+            self._encoder = getattr(self, self._encoders.get(self._dtype, '_encodeInvalid'))
+        self._interpreter = self._interpreters.get(self._dtype)
+        self._mask = (1 << size * 8) - 1
         self._client = client
         self._value = None
         self._t = None
         self._alias = None
+        self._aliasBytes = None
+        self._readReq = None
         self._polling = False
         self._pollTimer = None
         self._pollInterval_s = None
         self._format = None
+        self._formatBytesCache = (None, None)
         self._format_set(self.formats[0])
         self._autoCsv = False
         self._valueChangedRateLimiter = SignalRateLimiter(self.valueChanged, self.valueStringChanged, parent=self)
@@ -128,17 +160,21 @@ class Object(QObject):
 
     name = _Property(str, _name_get, constant=True)
 
+    # Matches one line of the reply to a list request: type, size, name.
+    _listResponse = re.compile(rb'^([0-9a-fA-F]{2})([0-9a-fA-F]+)(/.*)$', re.MULTILINE)
+
     @staticmethod
     def listResponseDecode(s, client):
-        split = s.split('/', 1)
-        if len(split) < 2:
-            return None
-        if len(split[0]) < 3:
-            return None
-        try:
-            return Object('/' + split[1], int(split[0][0:2], 16), int(split[0][2:], 16), client)
-        except ValueError:
+        if isinstance(s, str):
+            s = s.encode()
+        m = Object._listResponse.fullmatch(s)
+        if m == None:
             return None
+        return Object._listResponseMatch(m, client)
+
+    @staticmethod
+    def _listResponseMatch(m, client):
+        return Object(m.group(3).decode(), int(m.group(1), 16), int(m.group(2), 16), client)
 
     FlagSigned = 0x8
     FlagInt = 0x10
@@ -166,26 +202,47 @@ class Object(QObject):
 
     Invalid = 0xff
 
+    # Classification of all possible types, as cached by __init__() for the is...() functions below.
+    _ValidType = 0x1
+    _Function = 0x2
+    _Fixed = 0x4
+    _Int = 0x8
+    _Signed = 0x10
+    _Special = 0x20
+
+    _typeFlags = []
+    for _t in range(0, 0x100):
+        _typeFlags.append(
+            (_ValidType if _t & 0x80 == 0 else 0) |
+            (_Function if _t & FlagFunction != 0 else 0) |
+            (_Fixed if _t & FlagFixed != 0 else 0) |
+            (_Int if _t & FlagFixed != 0 and _t & FlagInt != 0 else 0) |
+            (_Signed if _t & FlagFixed != 0 and _t & FlagSigned != 0 else 0) |
+            (_Special if _t & 0x78 == 0 else 0))
+    del _t
+
+    _signedSizeByType = {Int8: 1, Int16: 2, Int32: 4, Int64: 8}
+
     def isValidType(self):
-        return self._type & 0x80 == 0
+        return self._isValidType
 
     def isFunction(self):
-        return self._type & self.FlagFunction != 0
+        return self._isFunction
 
     def isFixed(self):
-        return self._type & self.FlagFixed != 0
+        return self._isFixed
 
     def isInt(self):
-        return self.isFixed() and self._type & self.FlagInt != 0
+        return self._isInt
 
     def isSigned(self):
-        return self.isFixed() and self._type & self.FlagSigned != 0
+        return self._isSigned
 
     def isSpecial(self):
-        return self._type & 0x78 == 0
+        return self._isSpecial
 
     def _typeName_get(self):
-        dtype = self._type & ~self.FlagFunction
+        dtype = self._dtype
         t = {
                 self.Int8: 'int8',
                 self.Uint8: 'uint8',
@@ -206,7 +263,7 @@ class Object(QObject):
             }.get(dtype, '?')
         if dtype in [self.Blob, self.String]:
             t = f'{t}:{self.size}'
-        return f'({t})' if self.isFunction() else t
+        return f'({t})' if self._isFunction else t
 
     typeName = _Property(str, _typeName_get, constant=True)
 
@@ -218,6 +275,12 @@ class Object(QObject):
             return
 
         self._alias = a
+        if a == None:
+            self._aliasBytes = None
+            self._readReq = None
+        else:
+            self._aliasBytes = a.encode()
+            self._readReq = b'r' + self._aliasBytes
         self.aliasChanged.emit()
 
     alias = _Property(str, _alias_get, _alias_set, notify=aliasChanged)
@@ -238,6 +301,21 @@ class Object(QObject):
         # Still not alias, return name instead.
         return self._name
 
+    # Like shortName(), but returns the encoded name, as used in requests.
+    def shortNameBytes(self, tryToGetAlias = True):
+        if self._aliasBytes == None:
+            self.shortName(tryToGetAlias)
+            if self._aliasBytes == None:
+                return self._nameBytes
+
+        return self._aliasBytes
+
+    # Return the request to read this object.
+    def _readRequest(self, tryToGetAlias = True):
+        if self._readReq != None:
+            return self._readReq
+        return b'r' + self.shortNameBytes(tryToGetAlias)
+
     @staticmethod
     def sign_extend(value, bits):
         sign_bit = 1 << (bits - 1)
@@ -261,7 +339,7 @@ class Object(QObject):
             pass
         elif self._client != None:
             self._asyncReadPending = True
-            self._client.reqAsync(b'r' + self.shortName(False).encode(), self._asyncReadRep)
+            self._client.reqAsync(self._readRequest(False), self._asyncReadRep)
 
     def _asyncReadRep(self, rep):
         self._asyncReadPending = False
@@ -278,7 +356,7 @@ class Object(QObject):
         if self._client == None:
             return None
 
-        rep = self._client.req(b'r' + self.shortName(tryToGetAlias).encode())
+        rep = self._client.req(self._readRequest(tryToGetAlias))
         return self.decodeReadRep(rep)
 
     # Decode a read reply.
@@ -291,56 +369,76 @@ class Object(QObject):
         return value
 
     def _decodeHex(self, data):
-        data = data.decode()
-        if len(data) % 2 == 1:
-            data = '0' + data
-        res = bytearray()
-        for i in range(0, len(data), 2):
-            res.append(int(data[i:i+2], 16))
-        return res
+        if len(data) & 1:
+            data = b'0' + data
+        return bytearray(binascii.unhexlify(data))
+
+    # If an int >= 2^63 for Uint64, we run into problems in libshiboken.
+    # See https://bugreports.qt.io/browse/PYSIDE-648
+    _pyside648 = sys.version_info.major <= 3 and sys.version_info.minor < 9
 
     def _decode(self, rep):
-        dtype = self._type & ~self.FlagFunction
         try:
-            if self.isFixed():
-                binint = int(rep.decode(), 16)
-                if sys.version_info.major <= 3 and sys.version_info.minor < 9:
-                    # If binint >= 2^63 for Uint64, we run into problems in libshiboken.
-                    # See https://bugreports.qt.io/browse/PYSIDE-648
-                    # Force to Int64 in that case.
-                    if binint >= 1 << 63:
-                        binint -= 1 << 64
-                if self.isInt() and not self.isSigned():
-                    return binint
-                elif dtype == self.Int8:
-                    return self.sign_extend(binint, 8)
-                elif dtype == self.Int16:
-                    return self.sign_extend(binint, 16)
-                elif dtype == self.Int32:
-                    return self.sign_extend(binint, 32)
-                elif dtype == self.Int64:
-                    return self.sign_extend(binint, 64)
-                elif dtype == self.Float:
-                    return struct.unpack('<f', struct.pack('<I', binint))[0]
-                elif dtype == self.Double:
-                    return struct.unpack('<d', struct.pack('<Q', binint))[0]
-                elif dtype == self.Bool:
-                    return binint != 0
-                elif dtype == self.Pointer32 or dtype == self.Pointer64:
-                    return binint
-                else:
-                    return None
-            elif dtype == self.Void:
-                return b''
-            elif dtype == self.Blob:
-                return self._decodeHex(rep)
-            elif dtype == self.String:
-                return self._decodeHex(rep).partition(b'\x00')[0].decode()
-            else:
-                return None
+            return self._decoder(rep)
         except:
             return None
 
+    # Decoders per type, as selected by __init__().
+    def _decodeFixed(self, rep):
+        binint = int(rep.decode(), 16)
+        if self._pyside648:
+            # Force to Int64 in that case.
+            if binint >= 1 << 63:
+                binint -= 1 << 64
+        return binint
+
+    def _decodeInt(self, rep):
+        n = self._signedSize
+        if n == None or rep == b'':
+            return None
+        if len(rep) & 1:
+            rep = b'0' + rep
+        # Truncate or zero-extend to the size of the type, and let
+        # from_bytes() do the sign extension.
+        return int.from_bytes(binascii.unhexlify(rep)[-n:].rjust(n, b'\x00'), 'big', signed=True)
+
+    # The reply is the big-endian hex representation, with leading zeros stripped.
+    def _decodeFloat(self, rep):
+        if rep == b'':
+            return None
+        return _be_float.unpack(binascii.unhexlify(rep.rjust(8, b'0')))[0]
+
+    def _decodeDouble(self, rep):
+        if rep == b'':
+            return None
+        return _be_double.unpack(binascii.unhexlify(rep.rjust(16, b'0')))[0]
+
+    def _decodeBool(self, rep):
+        return self._decodeFixed(rep) != 0
+
+    def _decodeVoid(self, rep):
+        return b''
+
+    def _decodeBlob(self, rep):
+        return self._decodeHex(rep)
+
+    def _decodeString(self, rep):
+        return self._decodeHex(rep).partition(b'\x00')[0].decode()
+
+    def _decodeInvalid(self, rep):
+        return None
+
+    _decoders = {
+        Float: '_decodeFloat',
+        Double: '_decodeDouble',
+        Bool: '_decodeBool',
+        Pointer32: '_decodeFixed',
+        Pointer64: '_decodeFixed',
+        Void: '_decodeVoid',
+        Blob: '_decodeBlob',
+        String: '_decodeString',
+    }
+
     # Write value to server.
     @Slot(object, result=bool)
     def write(self, value = None):
@@ -365,13 +463,11 @@ class Object(QObject):
         if self._client == None:
             return False
 
-        dtype = self.type & ~self.FlagFunction
-
         data = self._encode(value)
         if data == None:
             return False
 
-        req = b'w' + data + self.shortName().encode()
+        req = b''.join((b'w', data, self.shortNameBytes()))
 
         if asyncCallback != None:
             self._client.reqAsync(req, asyncCallback)
@@ -383,7 +479,10 @@ class Object(QObject):
 
 
     def _encodeHex(self, data, zerostrip = False):
-        s = ''.join(['%02x' % b for b in data])
+        if not isinstance(data, (bytes, bytearray)):
+            # Don't let bytes() turn an int into that many zeros.
+            data = bytes(iter(data))
+        s = data.hex()
         if zerostrip:
             s = s.lstrip('0')
             if s == '':
@@ -391,36 +490,51 @@ class Object(QObject):
         return s.encode()
 
     def _encode(self, value):
-        dtype = self._type & ~self.FlagFunction
-
         try:
-            if dtype == self.Void:
-                return b''
-            elif dtype == self.Blob:
-                return self._encodeHex(value)
-            elif dtype == self.String:
-                return self._encodeHex(value.encode()) + b'00'
-            elif dtype == self.Pointer32:
-                return ('%x' % value).encode()
-            elif dtype == self.Pointer64:
-                return ('%x' % value).encode()
-            elif dtype == self.Bool:
-                return b'1' if value else b'0'
-            elif dtype == self.Float:
-                return self._encodeHex(struct.pack('>f', value))
-            elif dtype == self.Double:
-                return self._encodeHex(struct.pack('>d', value))
-            elif not self.isInt():
-                return None
-            elif self.isSigned():
-                return self._encodeHex(struct.pack('>q', value)[-self._size:], True)
-            else:
-                if value < 0:
-                    value += 1 << 64
-                return self._encodeHex(struct.pack('>Q', value)[-self._size:], True)
+            return self._encoder(value)
         except:
             return None
 
+    # Encoders per type, as selected by __init__().
+    def _encodeInt(self, value):
+        # Two's complement, truncated to the size of the object.
+        return b'%x' % (value & self._mask)
+
+    def _encodePointer(self, value):
+        return b'%x' % value
+
+    def _encodeFloat(self, value):
+        return _be_float.pack(value).hex().encode()
+
+    def _encodeDouble(self, value):
+        return _be_double.pack(value).hex().encode()
+
+    def _encodeBool(self, value):
+        return b'1' if value else b'0'
+
+    def _encodeVoid(self, value):
+        return b''
+
+    def _encodeBlob(self, value):
+        return self._encodeHex(value)
+
+    def _encodeString(self, value):
+        return self._encodeHex(value.encode()) + b'00'
+
+    def _encodeInvalid(self, value):
+        return None
+
+    _encoders = {
+        Float: '_encodeFloat',
+        Double: '_encodeDouble',
+        Bool: '_encodeBool',
+        Pointer32: '_encodePointer',
+        Pointer64: '_encodePointer',
+        Void: '_encodeVoid',
+        Blob: '_encodeBlob',
+        String: '_encodeString',
+    }
+
     # Locally set value, but do not actually write it to the server.
     def set(self, value, t = None):
         if t == None:
@@ -469,26 +583,29 @@ class Object(QObject):
 
     tString = _Property(str, _tString_get, notify=tStringChanged)
 
+    _interpreters = {
+        Int8: lambda x: int(x,0),
+        Uint8: lambda x: int(x,0),
+        Int16: lambda x: int(x,0),
+        Uint16: lambda x: int(x,0),
+        Int32: lambda x: int(x,0),
+        Uint32: lambda x: int(x,0),
+        Int64: lambda x: int(x,0),
+        Uint64: lambda x: int(x,0),
+        Float: float,
+        Double: float,
+        Pointer32: lambda x: int(x,0),
+        Pointer64: lambda x: int(x,0),
+        Bool: lambda x: x.lower() in ['true', '1'],
+        Blob: str.encode,
+        String: lambda x: x,
+        Void: lambda x: bytearray(),
+    }
+
     def interpret(self, value):
         if isinstance(value,str):
-            value = {
-                self.Int8: lambda x: int(x,0),
-                self.Uint8: lambda x: int(x,0),
-                self.Int16: lambda x: int(x,0),
-                self.Uint16: lambda x: int(x,0),
-                self.Int32: lambda x: int(x,0),
-                self.Uint32: lambda x: int(x,0),
-                self.Int64: lambda x: int(x,0),
-                self.Uint64: lambda x: int(x,0),
-                self.Float: lambda x: float(x),
-                self.Double: lambda x: float(x),
-                self.Pointer32: lambda x: int(x,0),
-                self.Pointer64: lambda x: int(x,0),
-                self.Bool: lambda x: x.lower() in ['true', '1'],
-                self.Blob: lambda x: x.encode(),
-                self.String: lambda x: x,
-                self.Void: lambda x: bytearray(),
-            }.get(self._type & ~self.FlagFunction, lambda x: x)(value)
+            if self._interpreter != None:
+                value = self._interpreter(value)
         return value
 
     # Returns the currently known value (without an actual read())
@@ -533,14 +650,23 @@ class Object(QObject):
 
         self._format = f
 
+        dtype = self._dtype
         if f == 'hex':
-            self._formatter = lambda x: hex(x & (1 << self._size * 8) - 1)
+            self._formatter = lambda x, mask=self._mask: hex(x & mask)
         elif f == 'bin':
             self._formatter = bin
         elif f == 'bytes':
-            self._formatter = self._formatBytes
+            if self._isInt:
+                self._formatter = lambda x, mask=self._mask, size=self._size: \
+                    _bytesString((x & mask).to_bytes(size, 'big'))
+            elif dtype == self.Float:
+                self._formatter = lambda x: _bytesString(_be_float.pack(x))
+            elif dtype == self.Double:
+                self._formatter = lambda x: _bytesString(_be_double.pack(x))
+            else:
+                self._formatter = self._formatBytes
         elif self._type == self.Float:
-            self._formatter = lambda x: f'{x:.6g}'
+            self._formatter = '{:.6g}'.format
         else:
             self._formatter = str
 
@@ -552,13 +678,15 @@ class Object(QObject):
     format = _Property(str, _format_get, _format_set, notify=formatChanged)
 
     def _formatBytes(self, value):
-        value = self._encode(value).decode()
-        value = '0' * (self._size * 2 - len(value)) + value
-        res = ''
-        for i in range(0, len(value), 2):
-            if res != []:
-                res += ' '
-            res += value[i:i+2]
+        # Blobs are mutable, so compare by value, not by identity.
+        if value == self._formatBytesCache[0]:
+            return self._formatBytesCache[1]
+
+        s = self._encode(value).decode().rjust(self._size * 2, '0')
+        res = ' '.join([s[i:i+2] for i in range(0, len(s), 2)])
+        if isinstance(value, bytearray):
+            value = bytes(value)
+        self._formatBytesCache = (value, res)
         return res
 
     def _formats_get(self):
@@ -566,7 +694,7 @@ class Object(QObject):
             return ['bytes']
 
         f = ['default', 'bytes']
-        if self.isFixed():
+        if self._isFixed:
             f += ['hex', 'bin']
         return f
 
@@ -614,6 +742,15 @@ class Object(QObject):
 
         self._pollTimer.start()
 
+    # Slow polling, while the client reads the value together with other
+    # objects via a macro.
+    def _pollSlowMacro(self, interval_s):
+        self._pollSetFlag(True)
+        self._autoCsv = True
+        self._pollInterval_s = interval_s
+        if self._pollTimer != None:
+            self._pollTimer.stop()
+
     def _pollRead(self):
         try:
             if self.alias == None:
@@ -679,11 +816,10 @@ class Stream(object):
         self._flushing = False
         self._decoder = None
 
-        cap = self._client.capabilities()
-        if not 's' in cap:
+        if not self._client.hasCapability('s'):
             raise ValueError('Stream capability missing')
 
-        self._compressed = 'f' in self._client.capabilities()
+        self._compressed = self._client.hasCapability('f')
         self.reset()
 
     @property
@@ -745,14 +881,17 @@ class Macro(object):
 
     Do not instantiate directly, but let ZmqClient acquire one for you.
     """
-    def __init__(self, client, reqsep=b'\n', repsep=b' '):
+    def __init__(self, client, reqsep=b'\n', repsep=b' ', csv=True):
         self._client = client
+        # Write a CSV row for every reply, or leave that to the objects.
+        self._csv = csv
 
         self._macro = client.acquireMacro()
         if self._macro != None:
             self._macro = self._macro.encode()
 
         self._cmds = {}
+        self._callbacks = []
 
         if isinstance(reqsep, str):
             reqsep = reqsep.encode()
@@ -762,7 +901,12 @@ class Macro(object):
             repsep = repsep.encode()
         self._repsep = repsep
 
+        # Echo the response separator between all commands.
+        self._cmdsep = reqsep + b'e' + repsep + reqsep
+        self._definition = None
+
         self._pending = False
+        self._dirty = False
 
     @property
     def macro(self):
@@ -776,6 +920,8 @@ class Macro(object):
         if isinstance(cmd, str):
             cmd = cmd.encode()
         self._cmds[key] = (cmd, cb)
+        self._callbacks = [x[1] for x in self._cmds.values()]
+        self._dirty = False
         self._update()
 
         # Check if it still works...
@@ -794,24 +940,50 @@ class Macro(object):
     def remove(self, key):
         if key in self._cmds:
             del self._cmds[key]
-            self._update()
+            self._callbacks = [x[1] for x in self._cmds.values()]
+            self._updateLater()
             return True
         else:
             return False
 
+    # Give the macro back to the client. Commands are run one by one afterwards.
+    def release(self):
+        self._dirty = False
+        if self._macro != None:
+            self._client.releaseMacro(self._macro.decode())
+            self._macro = None
+            self._definition = None
+
     def _update(self):
         if self._macro == None:
             return
 
-        cmds = []
-        for c in self._cmds.values():
-            if cmds != []:
-                cmds.append(b'e' + self._repsep)
-            cmds.append(c[0])
+        definition = self._cmdsep.join([c[0] for c in self._cmds.values()])
+        if definition == self._definition:
+            # Already set.
+            return
 
-        self._client.assignMacro(self._macro, cmds, self._reqsep)
+        if self._client.assignMacro(self._macro, [definition] if self._cmds else [], self._reqsep):
+            self._definition = definition
+        else:
+            self._definition = None
+
+    # Coalesce the updates of a burst of remove()s into one request.
+    def _updateLater(self):
+        if not self._client.useEventLoop:
+            self._update()
+        elif not self._dirty:
+            self._dirty = True
+            QTimer.singleShot(0, self._flush)
+
+    def _flush(self):
+        if self._dirty:
+            self._dirty = False
+            self._update()
 
     def run(self, asyncDecode=False):
+        self._flush()
+
         if self._macro != None:
             if asyncDecode:
                 if not self._pending:
@@ -821,26 +993,34 @@ class Macro(object):
             else:
                 return self.decode(self._client.req(self._macro))
         else:
-            for c in self._cmds.values():
-                if c[1] != None:
-                    c[1](self._client.req(c[0]))
-                else:
-                    self._client.req(c[0])
+            # No macro available; pipeline the commands instead.
+            cmds = list(self._cmds.values())
+            reps = self._client.reqMany([c[0] for c in cmds])
+            for (cmd, cb), rep in zip(cmds, reps):
+                if cb != None:
+                    cb(rep)
 
         return True
 
     def decode(self, rep, t=None, skip=0):
         self._pending = False
-        cb = [x[1] for x in self._cmds.values()]
+        cb = self._callbacks
         values = rep.split(self._repsep)
         if len(cb) != len(values) + skip:
             return False
 
-        for i in range(0, len(values)):
-            if cb[i + skip] != None:
-                cb[i + skip](values[i], t)
+        if t == None:
+            # All values are from the same reply, share the time stamp.
+            t = time.time()
 
-        if self._client.csv != None:
+        if skip > 0:
+            cb = cb[skip:]
+
+        for c, v in zip(cb, values):
+            if c != None:
+                c(v, t)
+
+        if self._csv and self._client.csv != None:
             self._client.csv.write(t)
 
         return True
@@ -848,6 +1028,25 @@ class Macro(object):
     def __len__(self):
         return len(self._cmds)
 
+class SlowPoll(QObject):
+    """All objects that are slow polled with the same interval, read by one macro."""
+
+    def __init__(self, macro, interval_s, parent=None):
+        super().__init__(parent=parent)
+        self.macro = macro
+        self.timer = QTimer(parent=self)
+        self.timer.timeout.connect(self._run)
+        self.timer.setSingleShot(False)
+        self.timer.setInterval(interval_s * 1000)
+        if interval_s < 2:
+            self.timer.setTimerType(Qt.CoarseTimer)
+        else:
+            self.timer.setTimerType(Qt.VeryCoarseTimer)
+
+    @Slot()
+    def _run(self):
+        self.macro.run(True)
+
 class Tracing(Macro):
     """Tracing command handling"""
     def __init__(self, client, t=None, stream='t'):
@@ -859,14 +1058,14 @@ class Tracing(Macro):
         self._streamQueued = False
         self._partial = b''
 
-        cap = self.client.capabilities()
-        if not 't' in cap:
+        client = self.client
+        if not client.hasCapability('t'):
             raise ValueError('Tracing capability missing')
-        if not 'm' in cap:
+        if not client.hasCapability('m'):
             raise ValueError('Macro capability missing')
-        if not 'e' in cap:
+        if not client.hasCapability('e'):
             raise ValueError('Echo capability missing')
-        if not 's' in cap:
+        if not client.hasCapability('s'):
             raise ValueError('Stream capability missing')
 
         self._stream = self._client.stream(stream, raw=True)
@@ -899,6 +1098,10 @@ class Tracing(Macro):
         self._stream.reset()
         self._updateTracing()
 
+    def _updateLater(self):
+        # The tracing state should follow immediately.
+        self._update()
+
     def _updateTracing(self, force=False):
         if self._enabled == None:
             # Initializing
@@ -993,20 +1196,32 @@ class ZmqClient(QObject):
         self.logger = logging.getLogger(__name__)
         self._multi = multi
         self._context = zmq.Context()
-        self._socket = self._context.socket(zmq.REQ)
+        self._address = f'tcp://{address}:{port}'
+        # A REQ socket enforces strict send/recv alternation. Use a DEALER
+        # socket instead, such that multiple requests can be in flight.
+        # Every request gets a tag, which the REP server returns as part of
+        # the envelope of the reply. Replies that do not belong to the
+        # request that is waited for, like a late reply to an abandoned
+        # request, are dropped.
+        self._socket = self._context.socket(zmq.DEALER)
+        self._reqTag = 0
         self.logger.debug('Connecting to %s:%d...', address, port)
-        self._socket.connect(f'tcp://{address}:{port}')
+        self._socket.connect(self._address)
         self.logger.debug('Connected')
         self._defaultPollInterval = 1
         self._capabilities = None
+        self._capabilitySet = None
         self._availableAliases = None
         self._temporaryAliases = {}
         self._permanentAliases = {}
         self._availableMacros = None
         self._usedMacros = []
         self._objects = None
+        self._objectTree = None
+        self._objectsByName = None
         self._fastPollMacro = None
         self._fastPollTimer = None
+        self._slowPolls = {}
         if csv == None:
             self.csv = None
         else:
@@ -1027,7 +1242,7 @@ class ZmqClient(QObject):
         if app != None:
             app.aboutToQuit.connect(self._aboutToQuit)
 
-        if 'f' in self.capabilities():
+        if self.hasCapability('f'):
             self.logger.debug('Streams are compressed')
 
         try:
@@ -1073,20 +1288,83 @@ class ZmqClient(QObject):
             return None
 
         self.logger.debug('req %s', message)
-        self._socket.send(message)
+        rep = self._recv(self._send(message))
+        self.logger.debug('rep %s', rep)
+        return rep
+
+    # Send the request, and return its tag.
+    def _send(self, message):
+        self._reqTag = (self._reqTag + 1) & 0xffffffff
+        tag = b'%x' % self._reqTag
+        # The tag is followed by the empty delimiter frame, which a REQ socket would add.
+        self._socket.send_multipart([tag, b'', message])
+        return tag
 
-        # Block till we have some message.
+    # Block till we have the reply with the given tag.
+    def _recv(self, tag):
         while True:
             try:
-                rep = b''.join(self._socket.recv_multipart(zmq.NOBLOCK))
-                break
+                t, rep = self._recvNoBlock()
+                if t == tag:
+                    return rep
+                self._dropReply(t, rep)
             except zmq.ZMQError as e:
                 if e.errno != zmq.EAGAIN:
                     raise
-            self._socket.poll(1000)
+                self._socket.poll(1000)
+
+    # Return the tag and the reply of the next message.
+    def _recvNoBlock(self):
+        msg = self._socket.recv_multipart(zmq.NOBLOCK)
+        return (msg[0], b''.join(msg[2:]))
+
+    def _dropReply(self, tag, rep):
+        self.logger.debug('dropped stale rep %s with tag %s', rep, tag)
+
+    def reqMany(self, messages):
+        """Send multiple requests at once, and return all responses in order.
+
+        All requests are sent before the first response is awaited, such
+        that the round-trip latency is only paid once for the whole batch.
+        """
+        messages = list(messages)
+        res = [None] * len(messages)
+        pending = []
+        for i in range(0, len(messages)):
+            m = messages[i]
+            if isinstance(m, str):
+                m = m.encode()
+            if m == b'':
+                res[i] = b''
+            else:
+                pending.append((i, m))
 
-        self.logger.debug('rep %s', rep)
-        return rep
+        if pending == []:
+            return self._reqManyResult(messages, res)
+
+        while self._reqQueue != []:
+            # Wait for all outstanding requests first.
+            QCoreApplication.processEvents(QEventLoop.AllEvents, 100)
+
+        if self._socket == None:
+            return self._reqManyResult(messages, res)
+
+        tags = []
+        for _, m in pending:
+            self.logger.debug('req %s', m)
+            tags.append(self._send(m))
+
+        # The replies come in order, so waiting for them one by one is fine.
+        for (i, _), tag in zip(pending, tags):
+            rep = self._recv(tag)
+            self.logger.debug('rep %s', rep)
+            res[i] = rep
+
+        return self._reqManyResult(messages, res)
+
+    @staticmethod
+    def _reqManyResult(messages, res):
+        return [r.decode() if isinstance(m, str) and r != None else r for m, r in zip(messages, res)]
 
     def reqAsync(self, message, callback=None):
         if isinstance(message,str):
@@ -1112,39 +1390,43 @@ class ZmqClient(QObject):
                 self.logger.warning('Async req returned an error, which was not handled')
             return
 
-        self._reqQueue.append((message, callback))
-        if len(self._reqQueue) == 1:
-            self._socketNotifier.setEnabled(True)
-            self._reqAsyncSendNext()
-        else:
-            self.logger.debug('req async queued %s', message)
+        if self._socket == None:
+            if callback != None:
+                callback(b'')
+            return
 
-    def _reqAsyncSendNext(self):
-        if self._socket != None and self._reqQueue != []:
-            req, _ = self._reqQueue[0]
-            self.logger.debug('req async send %s', req)
-            self._socket.send(req)
-        else:
-            self._socketNotifier.setEnabled(False)
+        # Do not wait for the previous responses; pipeline the request.
+        self.logger.debug('req async send %s', message)
+        self._reqQueue.append((self._send(message), message, callback))
+        self._socketNotifier.setEnabled(True)
+
+        if self._socket.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+            # The send may have consumed the edge-triggered notification of
+            # a response that is already there.
+            QTimer.singleShot(0, self._reqAsyncCheckResponse)
 
     @Slot()
     def _reqAsyncCheckResponse(self):
         res = False
 
         try:
-            while self._socket != None:
-                resp = b''.join(self._socket.recv_multipart(zmq.NOBLOCK))
-                self._reqAsyncHandleResponse(resp)
+            while self._socket != None and self._reqQueue != []:
+                self._reqAsyncHandleResponse(*self._recvNoBlock())
                 res = True
         except zmq.ZMQError as e:
             pass
         return res
 
-    def _reqAsyncHandleResponse(self, resp):
-        self.logger.debug('req async recv %s', resp)
+    def _reqAsyncHandleResponse(self, tag, resp):
         assert(self._reqQueue != [])
-        req, callback = self._reqQueue.pop(0)
-        self._reqAsyncSendNext()
+        if tag != self._reqQueue[0][0]:
+            self._dropReply(tag, resp)
+            return
+
+        self.logger.debug('req async recv %s', resp)
+        _, req, callback = self._reqQueue.pop(0)
+        if self._reqQueue == []:
+            self._socketNotifier.setEnabled(False)
         if callback != None:
             callback(resp)
         elif resp == b'?':
@@ -1162,11 +1444,11 @@ class ZmqClient(QObject):
                 raise TimeoutError()
 
             if self._socket == None:
-                self._reqAsyncHandleResponse(b'')
+                self._reqAsyncHandleResponse(self._reqQueue[0][0], b'')
                 continue
 
             try:
-                self._reqAsyncHandleResponse(b''.join(self._socket.recv_multipart(zmq.NOBLOCK)))
+                self._reqAsyncHandleResponse(*self._recvNoBlock())
             except zmq.ZMQError as e:
                 if e.errno != zmq.EAGAIN:
                     raise
@@ -1182,6 +1464,9 @@ class ZmqClient(QObject):
         except:
             pass
 
+        if self.csv != None:
+            self.csv.flush()
+
         try:
             app = QCoreApplication.instance()
             if app != None:
@@ -1266,6 +1551,8 @@ class ZmqClient(QObject):
         self.logger.debug('closing')
         if self._fastPollTimer:
             self._fastPollTimer.stop()
+        for p in self._slowPolls.values():
+            p.timer.stop()
         if self._tracingTimer:
             self._tracingTimer.stop()
         s = self._socket
@@ -1274,11 +1561,15 @@ class ZmqClient(QObject):
             s.close(0)
         self._aboutToQuit()
 
+        if self.csv != None:
+            self.csv.close()
+
         # Break all references to Objects for gc
         self._temporaryAliases = {}
         self._permanentAliases = {}
 
         self._fastPollMacro = None
+        self._slowPolls = {}
         self._tracing = None
         self._t = None
 
@@ -1286,6 +1577,8 @@ class ZmqClient(QObject):
             o.setParent(None)
 
         self._objects = None
+        self._objectTree = None
+        self._objectsByName = None
 
     def __enter__(self):
         return self
@@ -1307,9 +1600,15 @@ class ZmqClient(QObject):
             if self._multi:
                 # Remove capabilities that are stateful at the embedded side.
                 self._capabilities = re.sub(r'[amstf]', '', self._capabilities)
+            self._capabilitySet = frozenset(self._capabilities)
 
         return self._capabilities
 
+    def hasCapability(self, c):
+        if self._capabilitySet == None:
+            self.capabilities()
+        return c in self._capabilitySet
+
     @Slot(result=str)
     def echo(self, s):
         return self.req(b'e' + s.encode()).decode()
@@ -1345,71 +1644,60 @@ class ZmqClient(QObject):
             return
 
         res = []
-        for o in self.req(b'l').decode().split('\n'):
-            obj = Object.listResponseDecode(o, self)
-            if obj != None:
-                res.append(obj)
-                pyname = self.pyname(obj.name)
-                wobj = weakref.ref(obj)
-                setattr(ZmqClient, pyname, _Property(Object, lambda s, wobj=wobj: obj, constant=True))
+        # Scan the raw reply; only the names need to be decoded.
+        for m in Object._listResponse.finditer(self.req(b'l')):
+            obj = Object._listResponseMatch(m, self)
+            res.append(obj)
+            pyname = self.pyname(obj.name)
+            wobj = weakref.ref(obj)
+            setattr(ZmqClient, pyname, _Property(Object, lambda s, wobj=wobj: obj, constant=True))
 
         self._objects = res
 
+        # Index the objects by their name chunks, such that find() only has
+        # to visit the chunks that still match.
+        tree = {}
+        for obj in res:
+            node = tree
+            ochunks = obj.name.split('/')
+            for i in range(0, len(ochunks)):
+                oc = ochunks[i]
+                if not oc in node:
+                    node[oc] = (re.compile(re.sub(r'\\\?', '.', re.escape(oc)) + r'.*'), {}, [])
+                if i == len(ochunks) - 1:
+                    node[oc][2].append(obj)
+                else:
+                    node = node[oc][1]
+
+        self._objectTree = tree
+
+        byName = {}
+        for obj in res:
+            # Duplicates are ambiguous; leave them to find().
+            byName[obj.name] = None if obj.name in byName else obj
+        self._objectsByName = byName
+
     def find(self, name, all=False):
-        chunks = name.split('/')
-        obj1 = set()
-        obj2 = set()
-        obj3 = set()
-        obj4 = set()
         self._list_init()
-        for o in self._objects:
-            ochunks = o.name.split('/')
-            if len(chunks) != len(ochunks):
-                continue
 
-            # There are several cases:
-            # 1. The given name is an unambiguous full name, and the target has full names too. Expect exact match.
-            # 2. The given name is an unambiguous full name, while the target has abbreviated names.
-            # 3. The given name matches multiple objects, having full names, as it was ambiguous.
-            # 4. The object names are abbreviated, and the given name was ambiguous.
-
-            # Case 1.
-            match = True
-            for i in range(0, len(ochunks)):
-                # Assume abbreviated names.
-                if ochunks[i] != chunks[i]:
-                    match = False
-            if match:
-                obj1.add(o)
-
-            # Case 2.
-            match = True
-            for i in range(0, len(ochunks)):
-                if re.fullmatch(re.sub(r'\\\?', '.', re.escape(ochunks[i])) + r'.*', chunks[i]) == None:
-                    match = False
-                # It seems to match. Additional check: the object's chunk should not be longer, as it makes name ambiguous.
-                elif len(ochunks[i]) > len(chunks[i]):
-                    match = False
-            if match:
-                obj2.add(o)
+        if not all:
+            # An exact match is the best result.
+            obj = self._objectsByName.get(name)
+            if obj != None:
+                return obj
 
-            # Case 3.
-            match = True
-            for i in range(0, len(ochunks)):
-                if not ochunks[i].startswith(chunks[i]):
-                    match = False
-            if match:
-                obj3.add(o)
+        chunks = name.split('/')
 
-            # Case 4.
-            match = True
-            for i in range(0, len(ochunks)):
-                if re.fullmatch(re.sub(r'\\\?', '.', re.escape(ochunks[i])) + r'.*', chunks[i]) == None:
-                    match = False
-            if match:
-                obj4.add(o)
+        # There are several cases:
+        # 1. The given name is an unambiguous full name, and the target has full names too. Expect exact match.
+        # 2. The given name is an unambiguous full name, while the target has abbreviated names.
+        # 3. The given name matches multiple objects, having full names, as it was ambiguous.
+        # 4. The object names are abbreviated, and the given name was ambiguous.
+        found = (set(), set(), set(), set())
+        self._find(self._objectTree, chunks, 0, 0xf, found)
+        obj1 = found[0]
+        obj = obj1 | found[1] | found[2] | found[3]
 
-        obj = obj1 | obj2 | obj3 | obj4
         if all:
             return obj
         if len(obj1) == 1:
@@ -1422,6 +1710,39 @@ class ZmqClient(QObject):
         else:
             return obj
 
+    # Walk the object tree, while tracking (as bit mask) which of the cases
+    # of find() still match the chunks so far.
+    def _find(self, node, chunks, i, cases, found):
+        c = chunks[i]
+        last = i == len(chunks) - 1
+
+        for oc, (pattern, children, objs) in node.items():
+            match = cases
+
+            # Case 1.
+            if oc != c:
+                match &= ~1
+
+            # Case 2 and 4.
+            if match & 0xa and pattern.fullmatch(c) == None:
+                match &= ~0xa
+            # It seems to match. Additional check for case 2: the object's chunk should not be longer, as it makes name ambiguous.
+            elif len(oc) > len(c):
+                match &= ~2
+
+            # Case 3.
+            if match & 4 and not oc.startswith(c):
+                match &= ~4
+
+            if match == 0:
+                continue
+            elif not last:
+                self._find(children, chunks, i + 1, match, found)
+            else:
+                for j in range(0, 4):
+                    if match & (1 << j):
+                        found[j].update(objs)
+
     @Slot(str, result=Object)
     def obj(self, x):
         try:
@@ -1453,25 +1774,22 @@ class ZmqClient(QObject):
         return self.req(b'v').decode()
 
     def readMem(self, pointer, size):
-        rep = self.req(('R%x %d' % (pointer, size)).encode()).decode()
+        rep = self.req(b'R%x %d' % (pointer, size))
 
-        if rep == '?':
+        if rep == b'?':
             return None
 
         if len(rep) & 1:
             # Odd number of bytes.
             return None
 
-        res = bytearray()
-        for i in range(0, len(rep), 2):
-            res.append(int(rep[i:i+2], 16))
-        return res
+        return bytearray(binascii.unhexlify(rep))
 
     def writeMem(self, pointer, data):
-        req = 'W%x ' % pointer
-        for i in range(0, len(data)):
-            req += '%02x' % data[i]
-        rep = self.req(req.encode())
+        if not isinstance(data, (bytes, bytearray)):
+            data = bytes(iter(data))
+        req = b'W%x ' % pointer + data.hex().encode()
+        rep = self.req(req)
         return rep == b'!'
 
     def streams(self):
@@ -1516,11 +1834,17 @@ class ZmqClient(QObject):
 
         if self._availableAliases == None:
             # Not yet initialized
-            if 'a' in self.capabilities():
-                self._availableAliases = list(map(chr, range(0x20, 0x7f)))
-                self._availableAliases.remove('/')
+            if self.hasCapability('a'):
+                # Ordered set of aliases; popitem() returns the last one.
+                self._availableAliases = dict.fromkeys(map(chr, range(0x20, 0x7f)))
+                del self._availableAliases['/']
             else:
-                self._availableAliases = []
+                self._availableAliases = {}
+
+        if prefer == None and not self._availableAliases and not self._temporaryAliases:
+            # Nothing free and nothing to take over. Objects without an alias
+            # try again on every shortName(), so bail out early.
+            return None
 
         if prefer != None:
             if self._isAliasAvailable(prefer):
@@ -1569,8 +1893,7 @@ class ZmqClient(QObject):
                 return None
 
         # Success!
-        if a in self._availableAliases:
-            self._availableAliases.remove(a)
+        self._availableAliases.pop(a, None)
         if temporary:
             self._temporaryAliases[a] = obj
         else:
@@ -1590,8 +1913,7 @@ class ZmqClient(QObject):
             return None
 
         self._releaseAlias(a)
-        if a in self._availableAliases:
-            self._availableAliases.remove(a)
+        self._availableAliases.pop(a, None)
         if temporary:
             self._temporaryAliases[a] = obj
         else:
@@ -1610,21 +1932,20 @@ class ZmqClient(QObject):
 
         if obj != None:
             obj._alias_set(None)
-            self._availableAliases.append(alias)
+            self._availableAliases[alias] = None
 
         return obj
 
     def _getFreeAlias(self):
-        if self._availableAliases == []:
+        if len(self._availableAliases) == 0:
             return None
         else:
-            return self._availableAliases.pop()
+            return self._availableAliases.popitem()[0]
 
     def _getTemporaryAlias(self):
-        keys = list(self._temporaryAliases.keys())
-        if keys == []:
+        a = next(iter(self._temporaryAliases), None) # pick oldest one
+        if a == None:
             return None
-        a = keys[0] # pick oldest one
         self._releaseAlias(a)
         return a
 
@@ -1652,7 +1973,7 @@ class ZmqClient(QObject):
         if self._availableMacros == None:
             # Not initialized yet.
             capabilities = self.capabilities()
-            if not 'm' in capabilities:
+            if not self.hasCapability('m'):
                 # Not supported.
                 self._availableMacros = []
             else:
@@ -1679,14 +2000,11 @@ class ZmqClient(QObject):
         if isinstance(sep, str):
             sep = sep.encode()
 
-        definition = b'm' + m
-
+        definition = [b'm' + m]
         for cmd in cmds:
-            if isinstance(cmd, str):
-                cmd = cmd.encode()
-            definition += sep + cmd
+            definition.append(cmd.encode() if isinstance(cmd, str) else cmd)
 
-        return self.req(definition) == b'!'
+        return self.req(sep.join(definition)) == b'!'
 
     def releaseMacro(self, m):
         if m in self._usedMacros:
@@ -1716,22 +2034,66 @@ class ZmqClient(QObject):
         if self._fastPollMacro == None:
             self._fastPollMacro = Macro(self)
             self._fastPollTimer = QTimer(parent=self)
-            self._fastPollTimer.timeout.connect(lambda: self._fastPollMacro.run(True))
+            self._fastPollTimer.timeout.connect(self._pollFastRun)
             self._fastPollTimer.setInterval(self.fastPollThreshold_s * 1000)
             self._fastPollTimer.setSingleShot(False)
             self._fastPollTimer.setTimerType(Qt.PreciseTimer)
 
-        if not self._fastPollMacro.add(b'r' + obj.shortName().encode(), obj.decodeReadRep, obj):
+        self._pollSlowRemove(obj)
+
+        if not self._fastPollMacro.add(obj._readRequest(), obj.decodeReadRep, obj):
             self._pollSlow(obj, interval_s)
         else:
             obj._pollFast(interval_s)
             self._fastPollTimer.setInterval(min(self._fastPollTimer.interval(), interval_s * 1000))
             self._fastPollTimer.start()
 
+    @Slot()
+    def _pollFastRun(self):
+        self._fastPollMacro.run(True)
+
     def _pollSlow(self, obj, interval_s):
-        obj._pollSlow(max(self.slowPollInterval_s, interval_s))
+        interval_s = max(self.slowPollInterval_s, interval_s)
+
+        self._pollSlowRemove(obj)
+
+        # Read all objects with the same interval with one request, like
+        # fast polling does.
+        p = self._slowPolls.get(interval_s)
+        if p == None:
+            # Like a timer per object, CSV rows are only written on changes.
+            macro = Macro(self, csv=False)
+            if macro.macro == None:
+                # No macro available. Fall back to a timer per object.
+                obj._pollSlow(interval_s)
+                return
+
+            p = self._slowPolls[interval_s] = SlowPoll(macro, interval_s, parent=self)
+
+        # Set the polling state first, as add() already reads the value.
+        obj._pollSlowMacro(interval_s)
+        if not p.macro.add(obj._readRequest(), obj.decodeReadRep, obj):
+            if len(p.macro) == 0:
+                self._pollSlowRelease(interval_s)
+            obj._pollSlow(interval_s)
+        elif not p.timer.isActive():
+            p.timer.start()
+
+    def _pollSlowRemove(self, obj):
+        for interval_s, p in list(self._slowPolls.items()):
+            if p.macro.remove(obj) and len(p.macro) == 0:
+                self._pollSlowRelease(interval_s)
+
+    def _pollSlowRelease(self, interval_s):
+        # Give the macro back, such that it can be used for another interval.
+        p = self._slowPolls.pop(interval_s)
+        p.timer.stop()
+        p.setParent(None)
+        p.macro.release()
 
     def _pollStop(self, obj):
+        self._pollSlowRemove(obj)
+
         if self._fastPollMacro != None:
             self._fastPollMacro.remove(obj)
             if len(self._fastPollMacro) == 0:
@@ -1749,6 +2111,8 @@ class ZmqClient(QObject):
             self._pollFast(obj, interval_s)
             return
 
+        self._pollSlowRemove(obj)
+
         if self._tracingTimer == None:
             self._tracingTimer = QTimer(parent=self)
             self._tracingTimer.timeout.connect(self._tracing.process)
@@ -1756,7 +2120,7 @@ class ZmqClient(QObject):
             self._tracingTimer.setSingleShot(False)
             self._tracingTimer.setTimerType(Qt.PreciseTimer)
 
-        if not self._tracing.add(b'r' + obj.shortName().encode(), obj.decodeReadRep, obj):
+        if not self._tracing.add(obj._readRequest(), obj.decodeReadRep, obj):
             self.logger.debug('Cannot add %s for tracing, use polling instead', obj.name)
             self._pollFast(obj, interval_s)
             return
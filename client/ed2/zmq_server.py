@@ -19,6 +19,7 @@ import threading
 import io
 import logging
 import serial
+import collections
 
 from . import protocol
 
@@ -60,7 +61,7 @@ class ZmqServer(protocol.ProtocolLayer):
 
         self.register(self.socket, zmq.POLLIN)
         self.closing = False
-        self._rep_queue = []
+        self._rep_queue = collections.deque()
 
     def register(self, socket, flags):
         self.poller.register(socket, flags)
@@ -128,16 +129,18 @@ class ZmqServer(protocol.ProtocolLayer):
         self.encode(message)
 
     def decode(self, data):
-        if self._rep_queue != []:
-            self.logger.debug('rep ' + str(bytes(data)))
-            self._rep_queue.pop(0)(data)
+        if len(self._rep_queue) > 0:
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('rep %r', bytes(data))
+            self._rep_queue.popleft()(data)
         else:
-            self.logger.debug('unexpected rep ' + str(bytes(data)))
+            if self.logger.isEnabledFor(logging.DEBUG):
+                self.logger.debug('unexpected rep %r', bytes(data))
 
         super().decode(data)
 
     def isWaiting(self):
-        return self._rep_queue != []
+        return len(self._rep_queue) > 0
 
     def close(self):
         self.closing = True
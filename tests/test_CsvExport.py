@@ -0,0 +1,80 @@
+# libstored, distributed debuggable data stores.
+# Copyright (C) 2020-2021  Jochem Rutgers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+import tempfile
+import os
+import logging
+from ed2.csv import CsvExport
+
+class DummyObject:
+    def __init__(self, name, value):
+        self.name = name
+        self._value = value
+
+    def isFixed(self):
+        return True
+
+class CsvExportTest(unittest.TestCase):
+
+    def setUp(self):
+        # Never write into the working directory.
+        self.dir = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.dir.name, 'log.csv')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def read(self):
+        with open(self.filename, newline='') as f:
+            return f.read()
+
+    def flushClose(self, threaded):
+        c = CsvExport(filename=self.filename, threaded=threaded, autoFlush=None)
+        a = DummyObject('/a', 1)
+        c.add(a)
+        c.write(1.0)
+        c.flush()
+        self.assertEqual(self.read(), 't,/a\r\n1.0,1\r\n')
+
+        c.write(2.0)
+        c.close()
+        self.assertEqual(self.read(), 't,/a\r\n1.0,1\r\n2.0,1\r\n')
+
+        # Samples are dropped after closing, and the file is not reopened.
+        c.write(3.0)
+        c.remove(a)
+        c.flush()
+        self.assertEqual(self.read(), 't,/a\r\n1.0,1\r\n2.0,1\r\n')
+
+    def test_flushClose(self):
+        self.flushClose(False)
+
+    def test_flushCloseThreaded(self):
+        self.flushClose(True)
+
+    def test_flushRows(self):
+        c = CsvExport(filename=self.filename, threaded=False, autoFlush=None, flushRows=2)
+        c.add(DummyObject('/a', 1))
+        c.write(1.0)
+        self.assertEqual(self.read(), '')
+        c.write(2.0)
+        self.assertEqual(self.read(), 't,/a\r\n1.0,1\r\n2.0,1\r\n')
+        c.close()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()
@@ -0,0 +1,105 @@
+# libstored, distributed debuggable data stores.
+# Copyright (C) 2020-2021  Jochem Rutgers
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+
+import unittest
+import logging
+from ed2 import protocol
+
+class ProtocolStackTest(unittest.TestCase):
+
+    def connect(self, tx, rx):
+        # Pass all frames from tx to rx. The first frame is the ARQ reset,
+        # if any, which the peer acknowledges by sending it back.
+        frames = []
+        def down(data):
+            if frames == []:
+                tx.decode(data)
+            frames.append(data)
+            rx.decode(data)
+        tx.down = down
+
+    def roundTrip(self, description, data):
+        # Let one stack encode the data, and an identical one decode it.
+        tx = protocol.buildStack(description)
+        rx = protocol.buildStack(description)
+        self.connect(tx, rx)
+
+        out = []
+        rx.up = out.append
+        tx.encode(data)
+        return out
+
+    def test_ascii(self):
+        self.assertEqual(self.roundTrip('ascii', b'q\x7fz\x01'), [b'q\x7fz\x01'])
+
+    def test_ascii_arq(self):
+        self.assertEqual(self.roundTrip('ascii,arq', b'q\x7fz\x01'), [b'q\x7fz\x01'])
+
+    def test_ascii_arq_crc(self):
+        self.assertEqual(self.roundTrip('ascii,arq,crc8', b'q\x7fz\x01'), [b'q\x7fz\x01'])
+        self.assertEqual(self.roundTrip('ascii,arq,crc16', b'q\x7fz\x01'), [b'q\x7fz\x01'])
+
+    def test_ascii_segment_arq(self):
+        data = bytes(range(0, 0x100))
+        self.assertEqual(self.roundTrip('ascii,segment=8,arq,crc16', data), [data])
+
+    def test_term_arq(self):
+        nonDebugData = []
+        tx = protocol.buildStack('term,arq')
+        rx = protocol.buildStack('term,arq')
+        self.connect(tx, rx)
+        for l in rx:
+            if isinstance(l, protocol.TerminalLayer):
+                l.fdout = lambda x: nonDebugData.append(x.decode())
+
+        out = []
+        rx.up = out.append
+        # Only after the first encode, the terminal layer extracts messages.
+        rx.encode(b'')
+        tx.encode(b'msg')
+        for l in tx:
+            if isinstance(l, protocol.TerminalLayer):
+                l.inject(b'text')
+
+        self.assertEqual(out, [b'msg'])
+        self.assertEqual(nonDebugData, ['text'])
+
+    def test_ascii_memoryview(self):
+        out = []
+        l = protocol.AsciiEscapeLayer()
+        l.up = out.append
+        l.down = out.append
+        l.decode(memoryview(b'a\x7fAb'))
+        l.encode(memoryview(b'a\x01b'))
+        self.assertEqual(out, [b'a\x01b', b'a\x7fAb'])
+
+    def test_str(self):
+        # Layers accept str as well, not only the stack.
+        out = []
+        l = protocol.AsciiEscapeLayer()
+        l.down = out.append
+        l.encode('a\nb')
+        self.assertEqual(out, [b'a\x7fJb'])
+
+        out = []
+        l = protocol.TerminalLayer()
+        l.down = out.append
+        l.encode('abc')
+        self.assertEqual(out, [b'\x1b_abc\x1b\\'])
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    unittest.main()